@@ -350,11 +350,20 @@ def readascii(path,dimvals):
     model_dim = iris.coords.DimCoord(float(dimvals[2]),long_name="climate model",var_name="model",units=1)
     rcp_dim = iris.coords.DimCoord(float(dimvals[3]),long_name="rep. conc. pathway",var_name="rcp",units=1)
 
-    grid=np.zeros((1,int(((n-s)*2)+1),int(((e-w)*2)+1),1,1,1,1,1))
+    nlat=int(((n-s)*2)+1)
+    nlon=int(((e-w)*2)+1)
+
+    grid=np.zeros((1,nlat,nlon,1,1,1,1,1))
     grid.fill(-99)
 
-    latitude  = iris.coords.DimCoord(np.linspace(s, n, int((n-s)*2)+1), standard_name='latitude',  units='degrees_north', long_name='Latitude',  var_name='lat')
-    longitude = iris.coords.DimCoord(np.linspace(w, e, int((e-w)*2)+1), standard_name='longitude', units='degrees_east', long_name='Longitude', var_name='lon')
+    # Integer gridcell indices for every row, computed once for the whole file.
+    # Gridcells are on a regular 0.5deg grid so (coord-origin)*2 is the index,
+    # avoiding an np.where lookup against the coordinate points per cell
+    lat_idx=np.rint((df['V2'].to_numpy()-s)*2).astype(np.intp)
+    lon_idx=np.rint((df['V3'].to_numpy()-w)*2).astype(np.intp)
+
+    latitude  = iris.coords.DimCoord(np.linspace(s, n, nlat), standard_name='latitude',  units='degrees_north', long_name='Latitude',  var_name='lat')
+    longitude = iris.coords.DimCoord(np.linspace(w, e, nlon), standard_name='longitude', units='degrees_east', long_name='Longitude', var_name='lon')
 
     cube_templ=iris.cube.Cube(grid, dim_coords_and_dims=[(time,0),(latitude,1),(longitude,2),(prodlev,3),(irr_lev,4),(rcp_dim,5),(model_dim,6),(crop_dim,7)])
 
@@ -363,14 +372,10 @@ def readascii(path,dimvals):
         num=int(col[1:])
         if num > 3:
             cube_layer=cube_templ.copy()
-            for index, row in df.iterrows():
-                lat=row['V2']
-                lon=row['V3']
-                a=np.where(cube_layer.coord('latitude').points==float(lat))
-                b=np.where(cube_layer.coord('longitude').points==float(lon))
-                cube_layer.data[0,a[0][0],b[0][0],0,0,0,0,0]=row[col]
-
-            cube_layer.data=np.ma.masked_equal(cube_layer.data,-99.)
+            scratch=np.full((nlat,nlon),-99.0)
+            scratch[lat_idx,lon_idx]=df[col].to_numpy(copy=False)
+
+            cube_layer.data=np.ma.masked_equal(scratch.reshape(1,nlat,nlon,1,1,1,1,1),-99.)
             cube_layer.rename(var_nm[col])
             cube_layer.data.fill_value=-99.0
 
@@ -11,9 +11,10 @@ Description:
     Combine all data for a each year in the iFEED project. This data is comprised of
     120 files per year (10 production levels, 10 irrigation levels).
     Data is combined from all 120 individual ascii files (with 49 columns per file and each
-    row relating to a single 0.5degx0.5deg gridcell) into a set of 100 NetCDF files using
+    row relating to a single 0.5degx0.5deg gridcell) into a single NetCDF file using
     iris cubes. Program is set up to use multiprocessing also as the data combination
-    process can be time consuming. Data is then be combined using nco.
+    process can be time consuming. Each year is collated in memory and the
+    combined cubes are written out once at the end.
 
 Arguments:
     dir   : Location of the folder containing the yearly raw GLAM outputs. This should
@@ -43,13 +44,13 @@ Created June 2020
 
 import iris
 import numpy as np
-import pandas as pd
 import os
+import mmap
 import argparse
 import time
-from multiprocessing import Pool
+from multiprocessing import Pool, RawArray
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import errlib
-from nco import Nco
 
 countries={
         "malawi":0,
@@ -98,6 +99,34 @@ rcps={
 prod_lst=["0.1","0.2","0.3","0.4","0.5","0.6","0.7","0.8","0.9","1"]
 irr_lst=["0","0.1","0.2","0.3","0.4","0.5","0.6","0.7","0.8","0.9","1","2"]
 
+# the data columns; V1-V3 hold the year and gridcell coordinates
+datacols=["V{}".format(i) for i in range(4,50)]
+
+# the (prod index, irr index, filename suffix) triples are identical for
+# every year so are formatted once at import
+prodirr=[(ip,ii,"_"+prod+"_"+irr+"_1.out")
+         for ip,prod in enumerate(prod_lst) for ii,irr in enumerate(irr_lst)]
+
+# threads reading the 120 files of a year; the reads are I/O bound so
+# these can sit inside each multiprocessing worker
+innerthreads=8
+
+# numba is optional; when available the gridcell scatter for all 46 data
+# columns is compiled to a single machine-code pass over the file rows
+try:
+    from numba import njit
+except ImportError:
+    njit=None
+
+if njit is not None:
+    @njit(cache=True)
+    def scattergrid(vals,lat_idx,lon_idx,arr):
+        for k in range(vals.shape[0]):
+            for j in range(vals.shape[1]):
+                arr[k,lat_idx[j],lon_idx[j]]=vals[k,j]
+else:
+    scattergrid=None
+
 column={'V1': 'Year',
         'V2': 'Latitude',
         'V3': 'Longitude',
@@ -249,8 +278,6 @@ var_units={'V1' : 'year',
            'V49': 'cm'
            }
 
-nco=Nco()
-
 def nextPath(path_pattern):
     """
     Finds the next free path in an sequentially named list of files
@@ -261,22 +288,25 @@ def nextPath(path_pattern):
     file-2.txt
     file-3.txt
 
-    Runs in log(n) time where n is the number of existing files in sequence
+    Scans the containing directory once rather than probing candidate
+    paths with os.path.exists one at a time
     """
-    i = 1
 
-    # First do an exponential search
-    while os.path.exists(path_pattern % i):
-        i = i * 2
+    (folder, pattern) = os.path.split(path_pattern)
+    (head, tail) = pattern.split('%s')
 
-    # Result lies somewhere in the interval (i/2..i]
-    # We call this interval (a..b] and narrow it down until a + 1 = b
-    a, b = (i // 2, i)
-    while a + 1 < b:
-        c = (a + b) // 2 # interval midpoint
-        a, b = (c, b) if os.path.exists(path_pattern % c) else (a, c)
+    if folder == '':
+        folder = '.'
 
-    return path_pattern % b
+    highest = 0
+    if os.path.isdir(folder):
+        with os.scandir(folder) as it:
+            for entry in it:
+                num = entry.name[len(head):len(entry.name)-len(tail)]
+                if entry.name.startswith(head) and entry.name.endswith(tail) and num.isdigit():
+                    highest = max(highest, int(num))
+
+    return path_pattern % (highest + 1)
 
 
 def readargs():
@@ -367,124 +397,247 @@ def readargs():
 
 def getyrs(locdir):
 
+    # The year folders sit directly under locdir, so one scandir pass is
+    # enough; os.walk stats and lists the whole tree to build its triples
     yrs=[]
-    for fol in os.walk(locdir):
-        if len(fol[2]) >= 120:
-            yr=fol[0].split('/')[-1]
-            if not yr=='':
-                yrs.append(yr)
+    with os.scandir(locdir) as it:
+        for entry in it:
+            if entry.is_dir():
+                nfiles=sum(1 for fil in os.scandir(entry.path) if fil.is_file())
+                if nfiles >= 120:
+                    yrs.append(entry.name)
 
     return yrs
 
 
-def readascii(path,dimvals):
+def makecoords(dimvals):
+    '''
+    Build the coordinates that are fixed for an entire rcp run once,
+    instead of rebuilding them for every one of the 120 files per year.
+    The latitude/longitude coordinates are added by readascii when the
+    first file establishes the grid extent.
+    '''
+
+    coords={}
+
+    #coords['country'] = iris.coords.DimCoord(float(dimvals[0]),long_name="country",var_name="country",units=1)
+    coords['crop']  = iris.coords.DimCoord(float(dimvals[1]),long_name="crop",var_name="crop",units=1)
+    coords['model'] = iris.coords.DimCoord(float(dimvals[2]),long_name="climate model",var_name="model",units=1)
+    coords['rcp']   = iris.coords.DimCoord(float(dimvals[3]),long_name="rep. conc. pathway",var_name="rcp",units=1)
+
+    return coords
+
+def parseascii(path):
+    '''
+    Parse one raw GLAM file straight from its bytes into an (nrows, 49)
+    float32 array. The files are all-numeric and space delimited under a
+    V1..V49 header line, so numpy's C text parser does the whole job
+    without building a DataFrame per file.
+    '''
 
     try:
-        df = pd.read_csv(path, sep=' ')
+        # map the file rather than pulling it through buffered reads; the
+        # pages come straight from the os cache with no copy per syscall
+        with open(path,'rb') as fil:
+            with mmap.mmap(fil.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                vals=np.fromstring(mm[mm.find(b'\n')+1:],dtype=np.float32,sep=' ')
+        return vals.reshape(-1,49)
     except:
         raise errlib.FileError("Error reading file at "+path+"\n")
 
+def readascii(path,coords):
+
+    vals=parseascii(path)
+
     filenm = os.path.split(path)[1]
 
-    n=df['V2'].max()
-    s=df['V2'].min()
-    e=df['V3'].max()
-    w=df['V3'].min()
+    yrcol=vals[:,0]
+    lats=vals[:,1]
+    lons=vals[:,2]
 
-    if all(x == df['V1'][1] for x in df['V1']):
-        time = iris.coords.DimCoord(df['V1'][1],standard_name="time",long_name="Time",var_name="time",units="year")
-    else:
+    if not np.all(yrcol == yrcol[0]):
         print ("Error in data file "+filenm+".\n")
         print ("Multiple years read within same file")
 
-    prodlev = iris.coords.DimCoord(float(filenm.split('_')[-3]),long_name="production level",var_name="prod_lev",units=1)
-    irr_lev = iris.coords.DimCoord(float(filenm.split('_')[-2]),long_name="irrigation level",var_name="irr_lev",units=1)
-    #country_dim = iris.coords.DimCoord(float(dimvals[0]),long_name="country",var_name="country",units=1)
-    crop_dim = iris.coords.DimCoord(float(dimvals[1]),long_name="crop",var_name="crop",units=1)
-    model_dim = iris.coords.DimCoord(float(dimvals[2]),long_name="climate model",var_name="model",units=1)
-    rcp_dim = iris.coords.DimCoord(float(dimvals[3]),long_name="rep. conc. pathway",var_name="rcp",units=1)
+    if 'latitude' not in coords:
+        n=lats.max()
+        s=lats.min()
+        e=lons.max()
+        w=lons.min()
+        coords['latitude']  = iris.coords.DimCoord(np.linspace(s, n, int((n-s)*2)+1), standard_name='latitude',  units='degrees_north', long_name='Latitude',  var_name='lat')
+        coords['longitude'] = iris.coords.DimCoord(np.linspace(w, e, int((e-w)*2)+1), standard_name='longitude', units='degrees_east', long_name='Longitude', var_name='lon')
+
+    latitude=coords['latitude']
+    longitude=coords['longitude']
 
-    grid=np.zeros((1,int(((n-s)*2)+1),int(((e-w)*2)+1),1,1,1,1,1))
-    grid.fill(-99)
+    nlat=latitude.points.size
+    nlon=longitude.points.size
 
-    latitude  = iris.coords.DimCoord(np.linspace(s, n, int((n-s)*2)+1), standard_name='latitude',  units='degrees_north', long_name='Latitude',  var_name='lat')
-    longitude = iris.coords.DimCoord(np.linspace(w, e, int((e-w)*2)+1), standard_name='longitude', units='degrees_east', long_name='Longitude', var_name='lon')
+    # Integer gridcell indices for every row, computed once for the whole file.
+    # Gridcells are on a regular 0.5deg grid so (coord-origin)*2 is the index.
+    lat_idx=np.rint((lats-latitude.points[0])*2).astype(np.intp)
+    lon_idx=np.rint((lons-longitude.points[0])*2).astype(np.intp)
+
+    arr=np.full((len(datacols),nlat,nlon),-99.0,dtype=np.float32)
+    if scattergrid is not None:
+        scattergrid(np.ascontiguousarray(vals[:,3:].T),lat_idx,lon_idx,arr)
+    else:
+        # one fancy-index assignment scatters all 46 columns at once
+        arr[:,lat_idx,lon_idx]=vals[:,3:].T
 
-    cube_templ=iris.cube.Cube(grid, dim_coords_and_dims=[(time,0),(latitude,1),(longitude,2),(prodlev,3),(irr_lev,4),(rcp_dim,5),(model_dim,6),(crop_dim,7)])
+    return arr
+
+def makecubes(buf,yrs,coords):
+    '''
+    Build one cube per output variable from the filled data buffer for the
+    whole run. All years and (prod, irr) combinations arrive in a single
+    (year, variable, lat, lon, prod, irr) array so no cube concatenation
+    is needed.
+    '''
+
+    latitude=coords['latitude']
+    longitude=coords['longitude']
+
+    nlat=latitude.points.size
+    nlon=longitude.points.size
+
+    time = iris.coords.DimCoord(np.array([float(yr) for yr in yrs]),standard_name="time",long_name="Time",var_name="time",units="year")
+    prodlev = iris.coords.DimCoord(np.array([float(p) for p in prod_lst]),long_name="production level",var_name="prod_lev",units=1)
+    irr_lev = iris.coords.DimCoord(np.array([float(i) for i in irr_lst]),long_name="irrigation level",var_name="irr_lev",units=1)
+
+    dims=[(time,0),(latitude,1),(longitude,2),(prodlev,3),(irr_lev,4)]
+
+    # the single crop/model/rcp values of a run ride along as scalar
+    # coordinates rather than padding every variable with three size-1
+    # dimensions; merging rcp files later promotes them to dimensions
+    scalars=[(coords['rcp'],None),(coords['model'],None),(coords['crop'],None)]
 
     cubelist=iris.cube.CubeList([])
-    for col in df:
-        num=int(col[1:])
-        if num > 3:
-            cube_layer=cube_templ.copy()
-            for index, row in df.iterrows():
-                lat=row['V2']
-                lon=row['V3']
-                a=np.where(cube_layer.coord('latitude').points==float(lat))
-                b=np.where(cube_layer.coord('longitude').points==float(lon))
-                cube_layer.data[0,a[0][0],b[0][0],0,0,0,0,0]=row[col]
-
-            cube_layer.data=np.ma.masked_equal(cube_layer.data,-99.)
-            cube_layer.long_name=column[col]
-            cube_layer.units=var_units[col]
-            cube_layer.rename(var_nm[col])
-            cube_layer.data.fill_value=-99.0
-
-            cubelist.append(cube_layer)
+    for k,col in enumerate(datacols):
+        data=buf[:,k]
+
+        # unfilled gridcells and GLAM's -99 no-data marker become NaN, so
+        # no masked array (and its full-size mask copy) is carried around
+        data[data==-99.0]=np.nan
+
+        cube_layer=iris.cube.Cube(data, dim_coords_and_dims=dims, aux_coords_and_dims=scalars)
+        cube_layer.long_name=column[col]
+        cube_layer.units=var_units[col]
+        cube_layer.rename(var_nm[col])
+
+        cubelist.append(cube_layer)
 
     return cubelist
 
-def fullyr(data):
+def yearfiles(yr,valnames,ascdir):
+    '''
+    List the (prod index, irr index, path) entries for the 120 files
+    of a year. Only the common prefix is formatted here; the per-file
+    suffixes come ready-made from the module-level prodirr list.
+    '''
+
+    prefix=ascdir+yr+"/"+valnames[1]+"_"+valnames[0]+"_amma_"+valnames[2]+"_"
+    prefix=prefix+valnames[3]+"_Fut_"+yr
+
+    return [(ip,ii,prefix+suffix) for (ip,ii,suffix) in prodirr]
 
-    valnames=data[1][0]
-    ascdir = data[1][1]
-    dimvals = data[1][2]
-    outfil=data[1][3]
-    yr=data[0]
+# One reader pool per process, created on first use and reused for every
+# year that process handles, rather than spun up and torn down per year.
+# aiofiles-style async reads would dispatch the blocking parses to threads
+# anyway, so the executor is the event loop here.
+reader_pool=None
 
-    cubelst=iris.cube.CubeList([])
+def getreaders():
+    global reader_pool
+    if reader_pool is None:
+        reader_pool=ThreadPoolExecutor(max_workers=innerthreads)
+    return reader_pool
 
-    tot=len(prod_lst)*len(irr_lst)
+def readyear(yr,valnames,ascdir,coords,buf):
+    '''
+    Read the 120 (prod, irr) files of one year into the supplied
+    (variable, lat, lon, prod, irr) buffer slice
+    '''
+
+    tasks=yearfiles(yr,valnames,ascdir)
+
+    # the parses are I/O bound enough that threads overlap usefully
+    # within a single process
+    tot=len(tasks)
     n=0
-    for prod in prod_lst:
-        for irr in irr_lst:
-            n+=1
-            filenm=valnames[1]+"_"+valnames[0]+"_amma_"+valnames[2]+"_"
-            filenm=filenm+valnames[3]+"_Fut_"+yr+"_"+prod+"_"+irr+"_1.out"
-            path=ascdir+yr+"/"+filenm
+    executor=getreaders()
+    futures={executor.submit(readascii,path,coords):(ip,ii) for (ip,ii,path) in tasks}
+    for future in as_completed(futures):
+        (ip,ii)=futures[future]
+        buf[:,:,:,ip,ii]=future.result()
+        n+=1
+        print ("file {} of {} read for year {}".format(n,tot,yr))
+
+# The year buffer is allocated as shared memory by multiprocess_rcp and
+# inherited by the pool workers, and the run context (file naming values,
+# data directory, coords) is installed once per worker by the pool
+# initializer, so neither the grids nor the per-task arguments have to be
+# pickled for every year
+shared_buf=None
+worker_args=None
+
+def initworker(raw,shape,valnames,ascdir,coords):
+    '''
+    Attach a pool worker to the shared year buffer and store the run
+    context it will use for every year it processes
+    '''
+    global shared_buf, worker_args
+    shared_buf=np.frombuffer(raw,dtype=np.float32).reshape(shape)
+    worker_args=(valnames,ascdir,coords)
 
-            cubelst+=readascii(path, dimvals)
-            print ("cube {} of {} appended for year {}".format(n,tot,yr))
+def fullyr(data):
+
+    (iyr,yr)=data
+    (valnames,ascdir,coords)=worker_args
 
-    outnm="{}_{}.nc".format(outfil,data[0])
-    outcube(cubelst.concatenate(), outnm)
+    readyear(yr,valnames,ascdir,coords,shared_buf[iyr])
 
-    return outnm
+    return yr
 
 def multiprocess_rcp (indata):
 
     [yrs,ascdir,valnames,procs,dimvals,outfil]=indata
 
-    yearlist=[]
+    yrs=sorted(yrs)
 
     locproc=min(len(yrs),procs)
 
-    args=[valnames,ascdir,dimvals,outfil]
+    coords=makecoords(dimvals)
+
+    # read one file up front so the grid extent is known before the
+    # shared buffer is sized
+    readascii(yearfiles(yrs[0],valnames,ascdir)[0][2], coords)
+
+    nlat=coords['latitude'].points.size
+    nlon=coords['longitude'].points.size
+    shape=(len(yrs),len(datacols),nlat,nlon,len(prod_lst),len(irr_lst))
 
-    itterable = [[yr, args] for yr in yrs]
+    raw=RawArray('f',int(np.prod(shape)))
+    buf=np.frombuffer(raw,dtype=np.float32).reshape(shape)
+    buf.fill(-99.0)
 
-    list_of_chunks=np.array_split(itterable,len(itterable)/locproc)
+    itterable = list(enumerate(yrs))
 
     start=time.time()
 
-    with Pool(processes=locproc) as pool:
+    # One continuous stream of years rather than pool.map per chunk, so a
+    # worker that finishes a fast year immediately picks up the next one
+    # instead of idling at the end-of-chunk barrier. The workers fill the
+    # shared buffer in place and only hand back the year they finished.
+    with Pool(processes=locproc, initializer=initworker,
+              initargs=(raw,shape,valnames,ascdir,coords)) as pool:
 
-        for chunk in list_of_chunks:
-            yearlist+=pool.map(fullyr,chunk)
+        for yr in pool.imap_unordered(fullyr,itterable,chunksize=1):
+            print ("year {} complete".format(yr))
 
-    yearlist.sort()
+    outcubelst=makecubes(buf,yrs,coords)
 
-    catdata(yearlist,outfil)
+    outcube(outcubelst,outfil+'.nc')
 
     end=time.time()
 
@@ -494,46 +647,53 @@ def singleprocess_rcp (indata):
 
     [yrs,ascdir,valnames,procs,dimvals,outfil]=indata
 
+    yrs=sorted(yrs)
+
     start=time.time()
 
-    args=[valnames,ascdir,dimvals,outfil]
+    coords=makecoords(dimvals)
+
+    readascii(yearfiles(yrs[0],valnames,ascdir)[0][2], coords)
 
-    itterable = [[yr, args] for yr in yrs]
+    nlat=coords['latitude'].points.size
+    nlon=coords['longitude'].points.size
+    shape=(len(yrs),len(datacols),nlat,nlon,len(prod_lst),len(irr_lst))
 
-    yearlist=[]
+    buf=np.full(shape,-99.0,dtype=np.float32)
 
-    for data in itterable:
-        yearlist.append(fullyr(data))
+    for iyr,yr in enumerate(yrs):
+        readyear(yr,valnames,ascdir,coords,buf[iyr])
 
-    yearlist.sort()
+    outcubelst=makecubes(buf,yrs,coords)
 
-    catdata(yearlist,outfil)
+    outcube(outcubelst,outfil+'.nc')
 
     end=time.time()
 
-    print ('time to combine ascii to a set of nc files:',int(end-start))
+    print ('time to combine ascii to a single nc:',int(end-start))
 
 def outcube(cube, fname):
 
+    (path, file) = os.path.split(fname)
+    if path and not os.path.exists(path):
+        os.makedirs(path)
+
     if (os.path.exists(fname)):
         outfile=nextPath(fname[:-3]+'_%s.nc')
     else:
         outfile=fname
 
-    iris.fileformats.netcdf.save(cube, outfile, zlib=True)
-
-def catdata(catlist,outfil):
-
-    nco.ncks(input=catlist[0], output="{}_recdim.nc".format(catlist[0][:-3]), options=['-O','-h', '--mk_rec_dmn time'])
-    catlist.insert(1,"{}_recdim.nc".format(catlist[0][:-3]))
-    newfile=outfil+'.nc'
-    (path, file) = os.path.split(newfile)
-    if not os.path.exists(path):
-        os.makedirs(path)
-    nco.ncrcat(input=catlist[1:], output=newfile)
-
-    for file in catlist:
-        os.remove(file)
+    # chunk each variable as one (lat, lon, prod, irr) slab per year, so a
+    # whole map for a year decompresses in one read while the unlimited
+    # time dimension stays at chunk size 1; shuffle helps zlib on the
+    # float32 values
+    shape=cube[0].shape if isinstance(cube,iris.cube.CubeList) else cube.shape
+    chunks=(1,)+tuple(shape[1:])
+
+    # missing data is carried as NaN and advertised through _FillValue
+    iris.fileformats.netcdf.save(cube, outfile, zlib=True, complevel=4, shuffle=True,
+                                 chunksizes=chunks, fill_value=np.nan,
+                                 unlimited_dimensions=['time'])
 
 def main():
 